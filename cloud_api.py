@@ -1,8 +1,16 @@
 import enum
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from typing import (
+    Callable,
+    Dict,
+    Iterator,
     List,
     Optional,
+    Tuple,
     TypeVar,
 )
 
@@ -37,8 +45,14 @@ from yandex.cloud.serverless.functions.v1.function_service_pb2 import (
 )
 from yandex.cloud.serverless.functions.v1.function_service_pb2_grpc import FunctionServiceStub
 
+logger = logging.getLogger(__name__)
+
 T = TypeVar('T')  # noqa: VNE001
 
+# shared by all requests in the container for concurrent rpc fan-out. the size caps concurrent
+# calls to the api, threads are only started on demand
+_grpc_pool = ThreadPoolExecutor(max_workers=16)
+
 
 class AppException(Exception):
     def format(self) -> str:  # noqa: A003
@@ -48,10 +62,42 @@ class AppException(Exception):
         return str(self)
 
 
+class StaleList(list):
+    # cached list result returned because the api request failed, `age` is in seconds
+    def __init__(self, items: list, age: float) -> None:
+        super().__init__(items)
+        self.age = age
+
+
 class BaseRepo:
+    _id_regex = re.compile('[a-z0-9]{20}')
+    _page_size = 1000  # api maximum, a folder normally fits into one page
+
     def __init__(self, folder_id: str) -> None:
         self._folder_id = folder_id
 
+    @classmethod
+    def _is_id(cls, id_or_name: str) -> bool:
+        # names can have the same shape, so a matching value may still need a lookup by name
+        return cls._id_regex.fullmatch(id_or_name) is not None
+
+    def resolve_id(self, id_or_name: str) -> str:
+        # callback buttons always carry ids, so actions on them skip the lookup
+        if self._is_id(id_or_name):
+            return id_or_name
+        return self.get_single(id_or_name).id
+
+    def _iter_pages(self, list_method: Callable, request_class: Callable, items_field: str,
+                    filter_: Optional[str]) -> Iterator:
+        page_token = ''
+        while True:
+            resp = list_method(request_class(folder_id=self._folder_id, filter=filter_,
+                                             page_size=self._page_size, page_token=page_token))
+            yield from getattr(resp, items_field)
+            page_token = resp.next_page_token
+            if not page_token:
+                return
+
     @classmethod
     def _is_not_found(cls, error: grpc.RpcError):
         return isinstance(error, grpc.Call) and error.code() in (grpc.StatusCode.INVALID_ARGUMENT,
@@ -67,6 +113,42 @@ class BaseRepo:
                 raise AppException from e
         return wrapped
 
+    def _clear_related_caches(self) -> None:
+        # caches used to build list items, dropped when the list is explicitly refreshed
+        pass
+
+    @staticmethod
+    def cache_list(ttl: float, max_stale: float = 5 * 60) -> Callable[[T], T]:
+        # results are kept per folder and filter. on error the last result is returned if it is
+        # not older than `max_stale`. `fresh` (explicit refresh) skips the cache lookup.
+        # actions call `cache_clear` so the next list shows new statuses
+        def decorator(method):
+            cache: Dict[Tuple[str, Optional[str]], Tuple[float, list]] = {}
+
+            @wraps(method)
+            def wrapped(self, filter_: Optional[str] = None, *, fresh: bool = False):
+                key = (self._folder_id, filter_)
+                now = time.monotonic()
+                cached = cache.get(key)
+                if cached and not fresh and now - cached[0] < ttl:
+                    return cached[1]
+                if fresh:
+                    self._clear_related_caches()
+                try:
+                    items = method(self, filter_)
+                except AppException as err:
+                    if not cached or now - cached[0] >= max_stale:
+                        raise
+                    logger.warning('%s failed, using stale cache: %s', method.__qualname__,
+                                   err.format())
+                    return StaleList(cached[1], now - cached[0])
+                cache[key] = (now, items)
+                return items
+
+            wrapped.cache_clear = cache.clear
+            return wrapped
+        return decorator
+
 
 class InstanceStatus(enum.Enum):
     RUNNING = 'running'
@@ -76,6 +158,7 @@ class InstanceStatus(enum.Enum):
 
 
 class Instance:
+    __slots__ = ('id', 'name', 'status', 'public_ips')
     _STATUS_MAP = {
         YaInstance.PROVISIONING: InstanceStatus.IN_PROGRESS,
         YaInstance.RUNNING: InstanceStatus.RUNNING,
@@ -90,15 +173,15 @@ class Instance:
     }
 
     def __init__(self, ya_instance: YaInstance):
-        self._instance = ya_instance
         self.id: str = ya_instance.id
         self.name: str = ya_instance.name
-        self.status = self._STATUS_MAP[ya_instance.status]
-        self.public_ips: List[str] = []
-
-        for net in ya_instance.network_interfaces:
-            if net.primary_v4_address.one_to_one_nat:
-                self.public_ips.append(net.primary_v4_address.one_to_one_nat.address)
+        # values added to the api later arrive as plain ints
+        self.status = self._STATUS_MAP.get(ya_instance.status, InstanceStatus.ERROR)
+        self.public_ips: Tuple[str, ...] = tuple(
+            address.one_to_one_nat.address
+            for address in (net.primary_v4_address for net in ya_instance.network_interfaces)
+            if address.HasField('one_to_one_nat')
+        )
 
 
 class InstanceRepo(BaseRepo):
@@ -106,35 +189,39 @@ class InstanceRepo(BaseRepo):
         super().__init__(folder_id)
         self._client = client
 
+    @BaseRepo.cache_list(ttl=10)
     @BaseRepo.call_grpc
     def get_list(self, filter_: Optional[str] = None) -> List[Instance]:
-        resp = self._client.List(ListInstancesRequest(folder_id=self._folder_id, filter=filter_))
-        return [Instance(ya_instance) for ya_instance in resp.instances]
+        instances = self._iter_pages(self._client.List, ListInstancesRequest, 'instances', filter_)
+        return [Instance(ya_instance) for ya_instance in instances]
 
     @BaseRepo.call_grpc
     def get_single(self, id_or_name: str) -> Instance:
-        try:
-            ya_instance = self._client.Get(GetInstanceRequest(instance_id=id_or_name))
-        except grpc.RpcError as err:
-            if not self._is_not_found(err):
-                raise
-            instances = self.get_list(filter_=f'name="{id_or_name}"')
-            if not instances:
-                raise AppException('instance not found')
-            return instances[0]
-        return Instance(ya_instance)
+        if self._is_id(id_or_name):
+            try:
+                return Instance(self._client.Get(GetInstanceRequest(instance_id=id_or_name)))
+            except grpc.RpcError as err:
+                if not self._is_not_found(err):
+                    raise
+        instances = self.get_list(filter_=f'name="{id_or_name}"')
+        if not instances:
+            raise AppException('instance not found')
+        return instances[0]
 
     @BaseRepo.call_grpc
     def start(self, id_: str) -> None:
         self._client.Start(StartInstanceRequest(instance_id=id_))
+        self.get_list.cache_clear()
 
     @BaseRepo.call_grpc
     def stop(self, id_: str) -> None:
         self._client.Stop(StopInstanceRequest(instance_id=id_))
+        self.get_list.cache_clear()
 
     @BaseRepo.call_grpc
     def restart(self, id_: str) -> None:
         self._client.Restart(RestartInstanceRequest(instance_id=id_))
+        self.get_list.cache_clear()
 
 
 class PostgresClusterStatus(enum.Enum):
@@ -146,6 +233,7 @@ class PostgresClusterStatus(enum.Enum):
 
 
 class PostgresCluster:
+    __slots__ = ('id', 'name', 'status')
     _STATUS_MAP = {
         Cluster.STATUS_UNKNOWN: PostgresClusterStatus.UNKNOWN,
         Cluster.CREATING: PostgresClusterStatus.IN_PROGRESS,
@@ -158,10 +246,9 @@ class PostgresCluster:
     }
 
     def __init__(self, pg: Cluster):
-        self._pg = pg
         self.id: str = pg.id
         self.name: str = pg.name
-        self.status = self._STATUS_MAP[pg.status]
+        self.status = self._STATUS_MAP.get(pg.status, PostgresClusterStatus.UNKNOWN)
 
 
 class PostgresRepo(BaseRepo):
@@ -169,31 +256,34 @@ class PostgresRepo(BaseRepo):
         super().__init__(folder_id)
         self._client = client
 
+    @BaseRepo.cache_list(ttl=10)
     @BaseRepo.call_grpc
     def get_list(self, filter_: Optional[str] = None) -> List[PostgresCluster]:
-        resp = self._client.List(ListClustersRequest(folder_id=self._folder_id, filter=filter_))
-        return [PostgresCluster(pg) for pg in resp.clusters]
+        pgs = self._iter_pages(self._client.List, ListClustersRequest, 'clusters', filter_)
+        return [PostgresCluster(pg) for pg in pgs]
 
     @BaseRepo.call_grpc
     def get_single(self, id_or_name: str) -> PostgresCluster:
-        try:
-            pg = self._client.Get(GetClusterRequest(cluster_id=id_or_name))
-        except grpc.RpcError as err:
-            if not self._is_not_found(err):
-                raise
-            pgs = self.get_list(filter=f'name="{id_or_name}"')
-            if not pgs:
-                raise AppException('pg cluster not found')
-            return pgs[0]
-        return PostgresCluster(pg)
+        if self._is_id(id_or_name):
+            try:
+                return PostgresCluster(self._client.Get(GetClusterRequest(cluster_id=id_or_name)))
+            except grpc.RpcError as err:
+                if not self._is_not_found(err):
+                    raise
+        pgs = self.get_list(filter_=f'name="{id_or_name}"')
+        if not pgs:
+            raise AppException('pg cluster not found')
+        return pgs[0]
 
     @BaseRepo.call_grpc
     def start(self, id_: str) -> None:
         self._client.Start(StartClusterRequest(cluster_id=id_))
+        self.get_list.cache_clear()
 
     @BaseRepo.call_grpc
     def stop(self, id_: str) -> None:
         self._client.Stop(StopClusterRequest(cluster_id=id_))
+        self.get_list.cache_clear()
 
 
 class ServerlessFunctionStatus(enum.Enum):
@@ -202,8 +292,9 @@ class ServerlessFunctionStatus(enum.Enum):
 
 
 class ServerlessFunction:
+    __slots__ = ('id', 'name', 'status', 'invoke_url')
+
     def __init__(self, function: Function, is_opened: bool):
-        self._function = function
         self.id: str = function.id
         self.name: str = function.name
         self.status = (ServerlessFunctionStatus.OPENED
@@ -212,53 +303,75 @@ class ServerlessFunction:
 
 
 class ServerlessFunctionRepo(BaseRepo):
+    _PUBLIC_INVOKER_BINDING = AccessBinding(
+        role_id='serverless.functions.invoker',
+        subject=Subject(
+            id='allUsers',
+            type='system',
+        ),
+    )
+
+    # access policy rarely changes, so it outlives the functions list cache.
+    # function id: (fetch time, is opened). open/close drop the entry
+    _BINDINGS_TTL = 60
+    _bindings_cache: Dict[str, Tuple[float, bool]] = {}
+
     def __init__(self, folder_id: str, client: FunctionServiceStub) -> None:
         super().__init__(folder_id)
         self._client = client
 
-    def _get_bindings(self, function_id: str) -> List[AccessBinding]:
+    def _clear_related_caches(self) -> None:
+        self._bindings_cache.clear()
+
+    def _is_opened(self, function_id: str, *, fresh: bool = False) -> bool:
+        now = time.monotonic()
+        cached = self._bindings_cache.get(function_id)
+        if cached and not fresh and now - cached[0] < self._BINDINGS_TTL:
+            return cached[1]
         bindings_resp = self._client.ListAccessBindings(
             ListAccessBindingsRequest(resource_id=function_id),
         )
-        return list(bindings_resp.access_bindings)
+        is_opened = bool(bindings_resp.access_bindings)
+        self._bindings_cache[function_id] = (now, is_opened)
+        return is_opened
 
+    @BaseRepo.cache_list(ttl=30)
     @BaseRepo.call_grpc
     def get_list(self, filter_: Optional[str] = None) -> List[ServerlessFunction]:
-        resp = self._client.List(ListFunctionsRequest(folder_id=self._folder_id, filter=filter_))
-        funcs = []
-        for func in resp.functions:
-            is_opened = bool(self._get_bindings(func.id))
-            funcs.append(ServerlessFunction(func, is_opened))
-        return funcs
+        funcs = list(self._iter_pages(self._client.List, ListFunctionsRequest, 'functions',
+                                      filter_))
+        # stub is thread-safe, so bindings are requested concurrently over the same channel
+        opened = _grpc_pool.map(self._is_opened, [func.id for func in funcs])
+        return [ServerlessFunction(func, is_opened) for func, is_opened in zip(funcs, opened)]
 
     @BaseRepo.call_grpc
     def get_single(self, id_or_name: str) -> ServerlessFunction:
-        try:
-            func = self._client.Get(GetFunctionRequest(function_id=id_or_name))
-        except grpc.RpcError as err:
-            if not self._is_not_found(err):
-                raise
-            funcs = self.get_list(filter_=f'name="{id_or_name}"')
-            if not funcs:
-                raise AppException('function not found')
-            return funcs[0]
-        is_opened = bool(self._get_bindings(func.id))
-        return ServerlessFunction(func, is_opened)
+        if self._is_id(id_or_name):
+            # bindings only need the id, so they are requested while Get is in flight. grpc
+            # futures don't go through the sdk retry interceptor, so a pool thread is used.
+            # Get is live, so bindings skip their cache too
+            opened = _grpc_pool.submit(self._is_opened, id_or_name, fresh=True)
+            try:
+                func = self._client.Get(GetFunctionRequest(function_id=id_or_name))
+            except grpc.RpcError as err:
+                if not self._is_not_found(err):
+                    raise
+            else:
+                return ServerlessFunction(func, opened.result())
+        funcs = self.get_list(filter_=f'name="{id_or_name}"')
+        if not funcs:
+            raise AppException('function not found')
+        return funcs[0]
 
     @BaseRepo.call_grpc
     def open(self, id_: str) -> None:  # noqa: A003
+        # repeated fields copy assigned messages, so the shared binding is never mutated
         self._client.SetAccessBindings(SetAccessBindingsRequest(
             resource_id=id_,
-            access_bindings=[
-                AccessBinding(
-                    role_id='serverless.functions.invoker',
-                    subject=Subject(
-                        id='allUsers',
-                        type='system',
-                    ),
-                ),
-            ],
+            access_bindings=[self._PUBLIC_INVOKER_BINDING],
         ))
+        self._bindings_cache.pop(id_, None)
+        self.get_list.cache_clear()
 
     @BaseRepo.call_grpc
     def close(self, id_: str) -> None:
@@ -266,3 +379,5 @@ class ServerlessFunctionRepo(BaseRepo):
             resource_id=id_,
             access_bindings=[],
         ))
+        self._bindings_cache.pop(id_, None)
+        self.get_list.cache_clear()
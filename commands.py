@@ -1,18 +1,17 @@
 import inspect
 import logging
-import re
-from functools import partial
+from functools import lru_cache
+from itertools import count
 from typing import (
+    Any,
     Callable,
     Dict,
     List,
     Optional,
     Protocol,
     Tuple,
-    cast,
 )
 
-from emoji import emojize
 from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 from cloud_api import (
@@ -26,9 +25,19 @@ from cloud_api import (
     ServerlessFunction,
     ServerlessFunctionRepo,
     ServerlessFunctionStatus,
+    StaleList,
 )
 
 logger = logging.getLogger(__name__)
+_sub_command_counter = count()
+
+_WARNING_EMOJI = '⚠️'
+_REFRESH_LABEL = '♻️ refresh'
+_START_LABEL = '▶️ start'
+_STOP_LABEL = '⏹️ stop'
+_RESTART_LABEL = '🔁 restart'
+_OPEN_LABEL = '▶️ open'
+_CLOSE_LABEL = '⏹️ close'
 
 
 class ReplyFunc(Protocol):
@@ -42,16 +51,15 @@ class ReplyFunc(Protocol):
         ...
 
 
-class BoundReplyFunc(Protocol):
-    def __call__(self, text: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
-        ...
-
-
 class BaseCommand:
-    _def_regex = re.compile('def (.+)[(]')
-    _sub_commands: Dict[str, Tuple[Callable, list]]  # name: (func, args)
+    _sub_commands: Dict[str, Tuple[Callable, int, int]]  # name: (func, required args, all args)
     _default_command: Optional[str]
     _optional_command: Optional[str]
+    _help_text: str
+    _short_doc: str
+    _list_limit = 50  # keeps list replies within telegram message and keyboard limits
+    _ACTIONS: Tuple[Tuple[str, str], ...] = ()  # (button label, sub-command) shown by `get`
+    _list_refresh_row: List[InlineKeyboardButton]
 
     name: str
 
@@ -59,25 +67,36 @@ class BaseCommand:
         self._args = args
         self._request_id = request_id
         self._reply_raw = reply
-        self._reply = cast(BoundReplyFunc, partial(reply, edit=False))
-        self._reply_inline = cast(BoundReplyFunc, partial(reply, edit=True))
 
     def __init_subclass__(cls):
         super().__init_subclass__()
-        cls._sub_commands = {'help': (cls.help, [])}
+        cls._sub_commands = {'help': (cls.help, 0, 0)}
         cls._default_command = cls._optional_command = None
 
-        methods = cls._def_regex.findall(inspect.getsource(cls))
         members = [pair for pair in inspect.getmembers(cls) if hasattr(pair[1], '_is_sub_command')]
-        members.sort(key=lambda pair: methods.index(pair[0]))
+        members.sort(key=lambda pair: pair[1]._order)
 
         for name, method in members:
-            cls._sub_commands[name] = (method, getattr(method, '_args'))  # noqa: B009
+            args = getattr(method, '_args')  # noqa: B009
+            required_args_count = sum(1 for arg in args if not arg['optional'])
+            cls._sub_commands[name] = (method, required_args_count, len(args))
             if getattr(method, '_is_default', False):
                 cls._default_command = name
             elif getattr(method, '_is_optional', False):
                 cls._optional_command = name
 
+        # all of the help inputs are static, so it is rendered once per class
+        cls._short_doc = inspect.getdoc(cls)
+        docs = [f'/{cls.name} - {cls._short_doc}\n']
+        for func, _, _ in cls._sub_commands.values():
+            spec = getattr(func, '_formatted_spec', func.__name__)
+            docs.append(f'`/{cls.name} {spec}` - {inspect.getdoc(func)}')
+        cls._help_text = '\n'.join(docs)
+        # the list keyboard only serializes its buttons, so the static row is shared by all replies
+        cls._list_refresh_row = [
+            InlineKeyboardButton(_REFRESH_LABEL, callback_data=cls.format_command('list', 'true')),
+        ]
+
     @classmethod
     def register(cls, *, default: bool = False, optional: bool = False):
         def decorator(method: Callable) -> Callable:
@@ -107,29 +126,26 @@ class BaseCommand:
             method._args = args
             method._formatted_spec = ' '.join(spec)
             method._is_sub_command = True
+            method._order = next(_sub_command_counter)  # keeps definition order in help
             method._is_default = default
             method._is_optional = optional
             return method
         return decorator
 
     @classmethod
-    def format_command(cls, *args) -> str:
-        text = f'/{cls.name}'
-        if args:
-            text += ' ' + ' '.join(map(str, args))
-        return text
+    @lru_cache(maxsize=1024)  # callback data for the same resources is rendered over and over
+    def format_command(cls, *args: str) -> str:
+        if not args:
+            return f'/{cls.name}'
+        return f'/{cls.name} {" ".join(args)}'
 
     @classmethod
     def short_doc(cls) -> str:
-        return inspect.getdoc(cls)
+        return cls._short_doc
 
     @classmethod
     def build_help(cls) -> str:
-        docs = [f'/{cls.name} - {inspect.getdoc(cls)}\n']
-        for func, _ in cls._sub_commands.values():
-            spec = getattr(func, '_formatted_spec', func.__name__)
-            docs.append(f'`/{cls.name} {spec}` - {inspect.getdoc(func)}')
-        return emojize('\n'.join(docs))
+        return cls._help_text
 
     def help(self):  # noqa: A003
         """
@@ -138,9 +154,39 @@ class BaseCommand:
         help_text = self.build_help()
         self._reply(help_text)
 
+    def _reply_list(self, title: str, items: list, format_item: Callable[[Any], str], *,
+                    inline: bool) -> None:
+        shown = items[:self._list_limit]
+        if isinstance(items, StaleList):
+            title += f' ({_WARNING_EMOJI} cloud api unavailable, data is {int(items.age)}s old)'
+        text = [title]
+        text.extend(map(format_item, shown))
+        if len(items) > len(shown):
+            text.append(f'… and {len(items) - len(shown)} more')
+
+        format_command = self.format_command
+        keyboard = [[InlineKeyboardButton(item.name, callback_data=format_command('get', item.id))]
+                    for item in shown]
+        keyboard.append(self._list_refresh_row)
+        reply = self._reply_inline if inline else self._reply
+        reply('\n'.join(text), InlineKeyboardMarkup(keyboard))
+
+    def _build_actions_markup(self, id_: str) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(label, callback_data=self.format_command(action, id_))
+             for label, action in self._ACTIONS],
+            [InlineKeyboardButton(_REFRESH_LABEL, callback_data=self.format_command('get', id_))],
+        ])
+
+    def _reply(self, text: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        self._reply_raw(text, markup, edit=False)
+
+    def _reply_inline(self, text: str, markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        self._reply_raw(text, markup, edit=True)
+
     def _reply_error(self, text: str, *, inline: bool = False) -> None:
         logger.warning('[%s] error: %s', self._request_id, text)
-        text = emojize(f':warning: `{text}`')
+        text = f'{_WARNING_EMOJI} `{text}`'
         self._reply_raw(text, edit=inline)
 
     def run(self):
@@ -160,10 +206,9 @@ class BaseCommand:
             self._reply_error('action required')
             return
 
-        handler, handler_args = self._sub_commands[action]
-        required_handler_args = [arg for arg in handler_args if not arg['optional']]
-        if len(args) < len(required_handler_args) or len(args) > len(handler_args):
-            self._reply_error(f'wrong args count (expected {len(required_handler_args)})')
+        handler, required_args_count, args_count = self._sub_commands[action]
+        if not required_args_count <= len(args) <= args_count:
+            self._reply_error(f'wrong args count (expected {required_args_count})')
             return
 
         logger.info('[%s] action %r, args %s', self._request_id, action, args)
@@ -181,11 +226,12 @@ class InstanceCommand(BaseCommand):
     name = 'vm'
 
     _STATUS_EMOJI = {
-        InstanceStatus.RUNNING: emojize(':green_circle:'),
-        InstanceStatus.STOPPED: emojize(':red_circle:'),
-        InstanceStatus.IN_PROGRESS: emojize(':blue_circle:'),
-        InstanceStatus.ERROR: emojize(':red_exclamation_mark:'),
+        InstanceStatus.RUNNING: '🟢',
+        InstanceStatus.STOPPED: '🔴',
+        InstanceStatus.IN_PROGRESS: '🔵',
+        InstanceStatus.ERROR: '❗',
     }
+    _ACTIONS = ((_START_LABEL, 'start'), (_STOP_LABEL, 'stop'), (_RESTART_LABEL, 'restart'))
 
     def __init__(self, *args, repo: InstanceRepo, **kwargs):
         super().__init__(*args, **kwargs)
@@ -203,21 +249,8 @@ class InstanceCommand(BaseCommand):
         """
         show instances with their status and public ip
         """
-        instances = self._repo.get_list()
-        markup = InlineKeyboardMarkup()
-        text = ['choose vm']
-        for instance in instances:
-            text.append(self._format_instance(instance))
-            markup.add(
-                InlineKeyboardButton(instance.name,
-                                     callback_data=self.format_command('get', instance.id)),
-            )
-        markup.add(InlineKeyboardButton(emojize(':recycling_symbol: refresh'),
-                                        callback_data=self.format_command('list', 'true')))
-        if inline:
-            self._reply_inline('\n'.join(text), markup)
-        else:
-            self._reply('\n'.join(text), markup)
+        instances = self._repo.get_list(fresh=inline)
+        self._reply_list('choose vm', instances, self._format_instance, inline=inline)
 
     @BaseCommand.register(optional=True)
     def get(self, id_or_name: str) -> None:
@@ -225,51 +258,37 @@ class InstanceCommand(BaseCommand):
         show actions for specified instance
         """
         instance = self._repo.get_single(id_or_name)
-        markup = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(emojize(':play_button: start'),
-                                     callback_data=self.format_command('start', instance.id)),
-                InlineKeyboardButton(emojize(':stop_button: stop'),
-                                     callback_data=self.format_command('stop', instance.id)),
-                InlineKeyboardButton(emojize(':repeat_button: restart'),
-                                     callback_data=self.format_command('restart', instance.id)),
-            ],
-            [
-                InlineKeyboardButton(emojize(':recycling_symbol: refresh'),
-                                     callback_data=self.format_command('get', instance.id)),
-            ],
-        ])
-        self._reply_inline(self._format_instance(instance), markup)
+        self._reply_inline(self._format_instance(instance), self._build_actions_markup(instance.id))
 
     @BaseCommand.register()
     def start(self, id_or_name: str) -> None:
         """
         start the instance
         """
-        instance = self._repo.get_single(id_or_name)
-        self._repo.start(instance.id)
+        instance_id = self._repo.resolve_id(id_or_name)
+        self._repo.start(instance_id)
         # todo: "wait" button
-        self._reply_inline(f'instance `{instance.name}` starting')
+        self._reply_inline(f'instance `{id_or_name}` starting')
 
     @BaseCommand.register()
     def stop(self, id_or_name: str) -> None:
         """
         stop the instance
         """
-        instance = self._repo.get_single(id_or_name)
-        self._repo.stop(instance.id)
+        instance_id = self._repo.resolve_id(id_or_name)
+        self._repo.stop(instance_id)
         # todo: "wait" button
-        self._reply_inline(f'instance `{instance.name}` stopping')
+        self._reply_inline(f'instance `{id_or_name}` stopping')
 
     @BaseCommand.register()
     def restart(self, id_or_name: str) -> None:
         """
         restart the instance
         """
-        instance = self._repo.get_single(id_or_name)
-        self._repo.restart(instance.id)
+        instance_id = self._repo.resolve_id(id_or_name)
+        self._repo.restart(instance_id)
         # todo: "wait" button
-        self._reply_inline(f'instance `{instance.name}` restarting')
+        self._reply_inline(f'instance `{id_or_name}` restarting')
 
 
 class PostgresCommand(BaseCommand):
@@ -279,12 +298,13 @@ class PostgresCommand(BaseCommand):
     name = 'pg'
 
     _STATUS_EMOJI = {
-        PostgresClusterStatus.UNKNOWN: emojize(':white_question_mark:'),
-        PostgresClusterStatus.IN_PROGRESS: emojize(':blue_circle:'),
-        PostgresClusterStatus.RUNNING: emojize(':green_circle:'),
-        PostgresClusterStatus.ERROR: emojize(':red_exclamation_mark:'),
-        PostgresClusterStatus.STOPPED: emojize(':red_circle:'),
+        PostgresClusterStatus.UNKNOWN: '❔',
+        PostgresClusterStatus.IN_PROGRESS: '🔵',
+        PostgresClusterStatus.RUNNING: '🟢',
+        PostgresClusterStatus.ERROR: '❗',
+        PostgresClusterStatus.STOPPED: '🔴',
     }
+    _ACTIONS = ((_START_LABEL, 'start'), (_STOP_LABEL, 'stop'))
 
     def __init__(self, *args, repo: PostgresRepo, **kwargs):
         super().__init__(*args, **kwargs)
@@ -300,21 +320,8 @@ class PostgresCommand(BaseCommand):
         """
         show pg clusters with their status
         """
-        clusters = self._repo.get_list()
-        markup = InlineKeyboardMarkup()
-        text = ['choose pg cluster']
-        for cluster in clusters:
-            text.append(self._format_pg(cluster))
-            markup.add(
-                InlineKeyboardButton(cluster.name,
-                                     callback_data=self.format_command('get', cluster.id)),
-            )
-        markup.add(InlineKeyboardButton(emojize(':recycling_symbol: refresh'),
-                                        callback_data=self.format_command('list', 'true')))
-        if inline:
-            self._reply_inline('\n'.join(text), markup)
-        else:
-            self._reply('\n'.join(text), markup)
+        pgs = self._repo.get_list(fresh=inline)
+        self._reply_list('choose pg cluster', pgs, self._format_pg, inline=inline)
 
     @BaseCommand.register(optional=True)
     def get(self, id_or_name: str) -> None:
@@ -322,37 +329,25 @@ class PostgresCommand(BaseCommand):
         show actions for specified pg cluster
         """
         pg = self._repo.get_single(id_or_name)
-        markup = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(emojize(':play_button: start'),
-                                     callback_data=self.format_command('start', pg.id)),
-                InlineKeyboardButton(emojize(':stop_button: stop'),
-                                     callback_data=self.format_command('stop', pg.id)),
-            ],
-            [
-                InlineKeyboardButton(emojize(':recycling_symbol: refresh'),
-                                     callback_data=self.format_command('get', pg.id))
-            ],
-        ])
-        self._reply_inline(self._format_pg(pg), markup)
+        self._reply_inline(self._format_pg(pg), self._build_actions_markup(pg.id))
 
     @BaseCommand.register()
     def start(self, id_or_name: str) -> None:
         """
         start the cluster
         """
-        pg = self._repo.get_single(id_or_name)
-        self._repo.start(pg.id)
-        self._reply_inline(f'pg cluster `{pg.name}` starting')
+        pg_id = self._repo.resolve_id(id_or_name)
+        self._repo.start(pg_id)
+        self._reply_inline(f'pg cluster `{id_or_name}` starting')
 
     @BaseCommand.register()
     def stop(self, id_or_name: str) -> None:
         """
         stop the cluster
         """
-        pg = self._repo.get_single(id_or_name)
-        self._repo.stop(pg.id)
-        self._reply_inline(f'pg cluster `{pg.name}` stopping')
+        pg_id = self._repo.resolve_id(id_or_name)
+        self._repo.stop(pg_id)
+        self._reply_inline(f'pg cluster `{id_or_name}` stopping')
 
 
 class FunctionCommand(BaseCommand):
@@ -362,9 +357,10 @@ class FunctionCommand(BaseCommand):
     name = 'func'
 
     _STATUS_EMOJI = {
-        ServerlessFunctionStatus.OPENED: emojize(':green_circle:'),
-        ServerlessFunctionStatus.CLOSED: emojize(':prohibited:'),
+        ServerlessFunctionStatus.OPENED: '🟢',
+        ServerlessFunctionStatus.CLOSED: '🚫',
     }
+    _ACTIONS = ((_OPEN_LABEL, 'open'), (_CLOSE_LABEL, 'close'))
 
     def __init__(self, *args, repo: ServerlessFunctionRepo, **kwargs):
         super().__init__(*args, **kwargs)
@@ -379,21 +375,8 @@ class FunctionCommand(BaseCommand):
         """
         show functions with their public access status (opened / closed)
         """
-        functions = self._repo.get_list()
-        markup = InlineKeyboardMarkup()
-        text = ['choose function']
-        for function in functions:
-            text.append(self._format_func(function))
-            markup.add(
-                InlineKeyboardButton(function.name,
-                                     callback_data=self.format_command('get', function.id)),
-            )
-        markup.add(InlineKeyboardButton(emojize(':recycling_symbol: refresh'),
-                                        callback_data=self.format_command('list', 'true')))
-        if inline:
-            self._reply_inline('\n'.join(text), markup)
-        else:
-            self._reply('\n'.join(text), markup)
+        funcs = self._repo.get_list(fresh=inline)
+        self._reply_list('choose function', funcs, self._format_func, inline=inline)
 
     @BaseCommand.register(optional=True)
     def get(self, id_or_name: str) -> None:
@@ -401,37 +384,25 @@ class FunctionCommand(BaseCommand):
         show actions for specified function
         """
         function = self._repo.get_single(id_or_name)
-        markup = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(emojize(':play_button: open'),
-                                     callback_data=self.format_command('open', function.id)),
-                InlineKeyboardButton(emojize(':stop_button: close'),
-                                     callback_data=self.format_command('close', function.id)),
-            ],
-            [
-                InlineKeyboardButton(emojize(':recycling_symbol: refresh'),
-                                     callback_data=self.format_command('get', function.id))
-            ],
-        ])
-        self._reply_inline(self._format_func(function), markup)
+        self._reply_inline(self._format_func(function), self._build_actions_markup(function.id))
 
     @BaseCommand.register()
     def open(self, id_or_name: str) -> None:  # noqa: A003
         """
         allow public access to invoke function
         """
-        function = self._repo.get_single(id_or_name)
-        self._repo.open(function.id)
-        self._reply_inline(f'function `{function.name}` opened')
+        function_id = self._repo.resolve_id(id_or_name)
+        self._repo.open(function_id)
+        self._reply_inline(f'function `{id_or_name}` opened')
 
     @BaseCommand.register()
     def close(self, id_or_name: str) -> None:
         """
         disallow public access to invoke function
         """
-        function = self._repo.get_single(id_or_name)
-        self._repo.close(function.id)
-        self._reply_inline(f'function `{function.name}` closed')
+        function_id = self._repo.resolve_id(id_or_name)
+        self._repo.close(function_id)
+        self._reply_inline(f'function `{id_or_name}` closed')
 
 
 commands = {cls.name: cls for cls in BaseCommand.__subclasses__()}
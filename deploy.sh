@@ -11,3 +11,7 @@ yc serverless function version create \
   --environment BOT_TOKEN=$BOT_TOKEN \
   --environment FOLDER=$FOLDER \
   --environment TG_USERS_WHITELIST=$TG_USERS_WHITELIST
+
+# register the bot command menu for the deployed commands (webhook is left as is)
+pip install -r requirements.txt
+BOT_MODE=webhook python main.py
@@ -3,19 +3,26 @@
 import inspect
 import logging
 import os
-import re
 import sys
-from functools import partial
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from functools import lru_cache, partial
 from typing import (
+    Callable,
     List,
     Optional,
+    Set,
     Tuple,
     Union,
     cast,
 )
 
+import requests
 import telebot
-import yandexcloud
+from requests.adapters import HTTPAdapter
 from telebot.types import (
     BotCommand,
     CallbackQuery,
@@ -28,14 +35,28 @@ from commands import ReplyFunc, commands
 
 # todo: validate env
 # todo: .env file
+# env is read once at import, changes require a restart
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 CLOUD_TOKEN = os.getenv('CLOUD_TOKEN')
 FOLDER = os.getenv('FOLDER')
 DEBUG_LIB = os.getenv('DEBUG_LIB')
-USERS_WHITELIST = os.getenv('TG_USERS_WHITELIST', '').split(';')
+BOT_MODE = os.getenv('BOT_MODE', 'webhook')  # webhook / polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+USERS_WHITELIST = frozenset(filter(None, os.getenv('TG_USERS_WHITELIST', '').split(';')))
 
 telebot.apihelper.ENABLE_MIDDLEWARE = True
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode='markdown')  # some escaping problem. MarkdownV2 same
+# one keep-alive pool to api.telegram.org for all threads (reply pool, polling workers), so
+# bot api calls reuse established tls connections instead of a session per thread
+_telegram_session = requests.Session()
+_telegram_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+telebot.apihelper.CUSTOM_REQUEST_SENDER = _telegram_session.request
+telebot.apihelper.CONNECT_TIMEOUT = 3.5
+# some escaping problem. MarkdownV2 same
+# serverless entrypoint has to finish handling (and replying) before it returns, so handlers run
+# in its thread. polling hands updates to the telebot workers
+bot = telebot.TeleBot(
+    BOT_TOKEN, parse_mode='markdown', threaded=BOT_MODE == 'polling', num_threads=4,
+)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -47,8 +68,6 @@ logger.addHandler(handler)
 if DEBUG_LIB:
     logging.getLogger('TeleBot').setLevel(logging.DEBUG)
 
-command_regex = re.compile('/(?P<cmd>[^ ]+)(?P<args>.*)')
-
 
 class UsersWhiteList(telebot.custom_filters.SimpleCustomFilter):
     key = 'whitelist'
@@ -58,13 +77,21 @@ class UsersWhiteList(telebot.custom_filters.SimpleCustomFilter):
             message = event.message
         else:
             message = event
+        if event.from_user is None:  # channel posts and anonymous admins
+            return False
         sender = event.from_user.username
         if sender not in USERS_WHITELIST:
-            logger.warning('rejected message from user %r: %r', sender, message.text)
+            # text is user-controlled, so it is capped to keep log records small
+            logger.warning('rejected message from user %r: %.80r', sender, message.text)
             return False
         return True
 
 
+# replies are sent in background so handlers don't wait for telegram api round trips
+_reply_pool = ThreadPoolExecutor(max_workers=8)
+_pending_replies: Set[Future] = set()
+
+
 def _reply(
         chat_id: int,
         message_id: Optional[int],
@@ -72,12 +99,46 @@ def _reply(
         markup: Optional[InlineKeyboardMarkup] = None,
         *,
         edit: bool,
+) -> None:
+    _submit_reply(_send_reply, chat_id, message_id, text, markup, edit)
+
+
+def _answer_callback(call: CallbackQuery) -> None:
+    # the answer only stops the button spinner, so it doesn't have to wait for the command
+    _submit_reply(bot.answer_callback_query, call.id)
+
+
+def _submit_reply(send: Callable, *args) -> None:
+    future = _reply_pool.submit(send, *args)
+    _pending_replies.add(future)
+    future.add_done_callback(_reply_done)
+
+
+def _reply_done(future: Future) -> None:
+    _pending_replies.discard(future)
+    if future.exception():
+        logger.error('failed to send reply', exc_info=future.exception())
+
+
+def flush_replies() -> None:
+    wait(list(_pending_replies))
+
+
+def _send_reply(
+        chat_id: int,
+        message_id: Optional[int],
+        text: str,
+        markup: Optional[InlineKeyboardMarkup],
+        edit: bool,
 ) -> None:
     if message_id and edit:
-        # throws error if content (text, keyboard) is not changed
-        bot.edit_message_text(text, chat_id, message_id)
-        if markup:
-            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
+        try:
+            bot.edit_message_text(text, chat_id, message_id, reply_markup=markup)
+        except telebot.apihelper.ApiTelegramException as err:
+            # telegram rejects edits that don't change content (text, keyboard), e.g. refresh
+            if err.error_code != 400 or 'message is not modified' not in err.description:
+                raise
+            logger.info('message %s is not modified', message_id)
     else:
         bot.send_message(chat_id, text, reply_markup=markup)
 
@@ -86,6 +147,7 @@ def ss_entry(event: dict, _context):
     update = Update.de_json(event['body'])
     logger.debug('%r', update)
     bot.process_new_updates([update])
+    flush_replies()  # the function can be frozen right after return
     return {
         'statusCode': 200,
     }
@@ -93,18 +155,31 @@ def ss_entry(event: dict, _context):
 
 @bot.middleware_handler(update_types=['message', 'callback_query'])
 def log_messages(_bot_instance: telebot.TeleBot, event: Union[Message, CallbackQuery]):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    # middleware runs before the whitelist filter, so sender-less updates get here too
+    user = event.from_user
+    username = user.username if user else None
     if isinstance(event, CallbackQuery):
-        logger.info('[%s] callback from user %r: %r',
-                    event.id, event.from_user.username, event.data)
+        logger.info('[%s] callback from user %r: %r', event.id, username, event.data)
     else:
-        logger.info('[%s] message from user %r: %r', event.id, event.from_user.username, event.text)
+        logger.info('[%s] message from user %r: %r', event.id, username, event.text)
+
+
+HELP_TEXT = '**available commands**:\n\n/help - show this help\n\n' + '\n\n'.join(
+    command.build_help() for command in commands.values()
+)
+BOT_COMMANDS = [
+    BotCommand('help', 'show help'),
+] + [
+    BotCommand(command.name, command.short_doc())
+    for command in commands.values()
+]
 
 
 @bot.message_handler(whitelist=True, commands=['start', 'help'])
 def handle_help(message: Message):
-    docs = [command.build_help() for command in commands.values()]
-    doc = '**available commands**:\n\n/help - show this help\n\n' + '\n\n'.join(docs)
-    bot.send_message(message.chat.id, doc)
+    bot.send_message(message.chat.id, HELP_TEXT)
 
 
 @bot.message_handler(whitelist=True, commands=list(commands.keys()))
@@ -113,42 +188,79 @@ def handle_commands(message: Message):
     process_command(reply, message.text, str(message.id))
 
 
-@bot.callback_query_handler(whitelist=True, func=lambda call: True)
+# telebot requires `func`, but drops None filters, so every whitelisted callback matches
+@bot.callback_query_handler(whitelist=True, func=None)
 def handle_callback_query(call: CallbackQuery):
+    _answer_callback(call)
     reply = cast(ReplyFunc, partial(_reply, call.message.chat.id, call.message.id))
     process_command(reply, call.data, str(call.id))
-    bot.answer_callback_query(call.id)
 
 
 def process_command(reply: ReplyFunc, command_text: str, request_id: str) -> None:
     command_name, args = parse_command_args(command_text)
     logger.info('[%s] command %r, args %s', request_id, command_name, args)
-    command_class = commands[command_name]
-    sdk = yandexcloud.SDK(token=CLOUD_TOKEN)
+    if command_name not in command_dispatch:
+        logger.warning('[%s] unknown command %r', request_id, command_name)
+        return
+    command_class, repo_class, client_stub = command_dispatch[command_name]
+    # a failing command must not break the rest of the update batch (or the polling loop)
+    try:
+        client = get_client(client_stub)
+        repo = repo_class(FOLDER, client)
+        command = command_class(args, request_id, reply, repo=repo)
+        command.run()
+    except Exception:
+        logger.exception('[%s] command %r failed', request_id, command_name)
+
+
+def resolve_repo(command_class: type) -> Tuple[type, type]:
     repo_class = inspect.signature(command_class.__init__).parameters['repo'].annotation
     client_stub = inspect.signature(repo_class.__init__).parameters['client'].annotation
-    client = sdk.client(client_stub)
-    repo = repo_class(FOLDER, client)
-    command = command_class(args, request_id, reply, repo=repo)
-    command.run()
+    return repo_class, client_stub
 
 
-def parse_command_args(text: str) -> Tuple[str, List[str]]:
-    match = command_regex.match(text).groupdict()
-    cmd = match['cmd']
-    args = match.get('args', '').split()
-    return cmd, args
+# name: (command class, repo class, client stub), resolved once so updates skip reflection
+command_dispatch = {
+    name: (command_class, *resolve_repo(command_class))
+    for name, command_class in commands.items()
+}
+
+
+@lru_cache(maxsize=None)
+def get_sdk():
+    # sdk keeps one grpc channel per api endpoint, so it is built once and shared by all clients.
+    # imported on first use: updates like /help don't need it, and the import is slow on cold start
+    import yandexcloud
+    from yandexcloud import _auth_plugin
+    # iam token is valid for 12 hours, but the sdk requests a new one every 20 seconds (from the
+    # metadata service in the deployed function, by oauth token exchange with CLOUD_TOKEN).
+    # TIMEOUT_SECONDS is a private global of the pinned 0.125.x sdk: check it on sdk upgrades
+    _auth_plugin.TIMEOUT_SECONDS = 60 * 60
+    return yandexcloud.SDK(token=CLOUD_TOKEN)
+
+
+@lru_cache(maxsize=None)
+def get_client(client_stub: type):
+    return get_sdk().client(client_stub)
+
+
+def parse_command_args(text: Optional[str]) -> Tuple[str, List[str]]:
+    if not text or not text.startswith('/'):
+        return '', []
+    head, _, args = text.partition(' ')
+    return head[1:], args.split()
 
 
 bot.add_custom_filter(UsersWhiteList())
-bot.set_my_commands(
-    [
-        BotCommand('help', 'show help'),
-    ] + [
-        BotCommand(command.name, command.short_doc())
-        for command in commands.values()
-    ]
-)
 
 if __name__ == '__main__':
-    bot.polling()
+    # registered once per setup run (deploy.sh runs it) instead of on every cold start
+    bot.set_my_commands(BOT_COMMANDS)
+    if BOT_MODE == 'webhook':
+        # updates are pushed to the serverless entrypoint (ss_entry), so only register the hook.
+        # without WEBHOOK_URL the current hook is kept and only commands are updated
+        if WEBHOOK_URL:
+            bot.set_webhook(url=WEBHOOK_URL)
+    else:
+        bot.remove_webhook()
+        bot.infinity_polling(timeout=20, long_polling_timeout=20, skip_pending=True)